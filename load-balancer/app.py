@@ -1,4 +1,6 @@
 import hashlib
+import json
+import math
 import random
 import threading
 import time
@@ -14,6 +16,8 @@ from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeou
 import geoip2.database
 import os
 
+from rate_limiter import RateLimiter
+
 import pprint
 
 pp = pprint.PrettyPrinter(indent=2)
@@ -30,6 +34,10 @@ prom = PrometheusConnect(url="http://prometheus:9090", disable_ssl=True)
 REQUEST_COUNT = Counter('load_balancer_requests_total', 'Total requests')
 RESPONSE_TIME = Histogram('load_balancer_response_duration_seconds', 'Response durations', ['algo'])
 ALGO_REQUEST_COUNT = Counter('load_balancer_algo_requests_total', 'Requests per algorithm', ['algo'])
+RATE_LIMIT_ALLOWED = Counter('load_balancer_rate_limit_allowed_total', 'Requests allowed by the rate limiter',
+                             ['limit', 'key_type'])
+RATE_LIMIT_REJECTED = Counter('load_balancer_rate_limit_rejected_total', 'Requests rejected by the rate limiter',
+                              ['limit', 'key_type'])
 
 # Server pool
 servers = [
@@ -50,6 +58,41 @@ servers = [
 executor = ThreadPoolExecutor(max_workers=50)  # Configurable pool
 
 
+
+def env_list(name, default=''):
+    return [item.strip() for item in os.environ.get(name, default).split(',') if item.strip()]
+
+
+# Rate limits per route, then per algorithm ('default' applies to algorithms without their own entry).
+# rate = tokens refilled per second, burst = bucket capacity. Override with RATE_LIMITS as JSON.
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+RATE_LIMITS = json.loads(os.environ['RATE_LIMITS']) if 'RATE_LIMITS' in os.environ else {
+    '/': {
+        'default': {'rate': 20, 'burst': 40},
+        'adaptive': {'rate': 10, 'burst': 20},
+    },
+}
+
+# Google front ends of the GCP external HTTP load balancer (deployment/main.tf) that proxy to this app.
+# They append "<client IP>, <load balancer IP>" to X-Forwarded-For, hence one trailing entry to skip.
+GCP_FRONT_END_RANGES = '35.191.0.0/16,130.211.0.0/22'
+
+# Clients are keyed by a known API key first, then by any matching CIDR (tenant), then by IP.
+# X-Forwarded-For is only trusted when the request arrives from one of the trusted proxies.
+rate_limiter = RateLimiter(
+    RATE_LIMITS if RATE_LIMIT_ENABLED else {},
+    redis_client=redis_client,
+    api_key_header='X-API-Key',
+    api_keys=env_list('RATE_LIMIT_API_KEYS'),
+    cidrs=env_list('RATE_LIMIT_CIDRS'),
+    trusted_proxies=env_list('RATE_LIMIT_TRUSTED_PROXIES', GCP_FRONT_END_RANGES),
+    forwarded_skip=int(os.environ.get('RATE_LIMIT_FORWARDED_SKIP', 1)),
+    workers=int(os.environ.get('RATE_LIMIT_WORKERS', 4)),  # matches gunicorn -w in the Dockerfile
+    max_buckets=10000,
+    sync_interval=1.0,
+)
+
+
 @app.route('/')
 def load_balancer():
     start_time = time.time()
@@ -59,14 +102,24 @@ def load_balancer():
     if not algo:
         algo = "adaptive"
 
+    print("Printing X-Forwaded-For header: ", request.headers.get('X-Forwarded-For', request.remote_addr))
+    client_ip = request.headers.get('X-Forwarded-For', request.remote_addr).split(',')[0].strip()
+
+    limit_ip = rate_limiter.client_ip(request.remote_addr, request.headers.get('X-Forwarded-For'))
+    allowed, limit_name, key_type, retry_after = rate_limiter.allow(request.path, algo, request.headers, limit_ip)
+    if limit_name:
+        # Label by the configured limit, not the raw ?algo= value, to keep metric cardinality bounded
+        if not allowed:
+            RATE_LIMIT_REJECTED.labels(limit=limit_name, key_type=key_type).inc()
+            return {'error': 'Rate limit exceeded'}, 429, {'Retry-After': str(max(1, math.ceil(retry_after)))}
+        RATE_LIMIT_ALLOWED.labels(limit=limit_name, key_type=key_type).inc()
+
     # Reset index for round-robin family if algo changes
     prev_algo = redis_client.get("last_used_algo")
     redis_client.set("last_used_algo", algo)
     if algo in ['round_robin', 'weighted_round_robin'] and prev_algo not in ['round_robin', 'weighted_round_robin']:
         redis_client.set("next_server_index", 0)
 
-    print("Printing X-Forwaded-For header: ", request.headers.get('X-Forwarded-For', request.remote_addr))
-    client_ip = request.headers.get('X-Forwarded-For', request.remote_addr).split(',')[0].strip()
     selected_server_info = select_server(algo, client_ip)
     if not selected_server_info:
         return {'error': 'No backend available'}, 503
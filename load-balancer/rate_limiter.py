@@ -0,0 +1,286 @@
+import functools
+import ipaddress
+import math
+import threading
+import time
+from collections import OrderedDict
+
+# Reconcile a batch of buckets with Redis in a single round trip.
+# KEYS: bucket keys. ARGV: now, then (consumed, rate, burst, ttl) per key.
+# The ttl covers a full refill; the script extends it by the time any debt needs.
+# Returns the global token count for each key after applying local consumption.
+# The count may go negative: tokens over-admitted between syncs become debt that
+# has to refill before the client is admitted again.
+SYNC_SCRIPT = """
+local now = tonumber(ARGV[1])
+local result = {}
+for i, key in ipairs(KEYS) do
+    local base = 1 + (i - 1) * 4
+    local consumed = tonumber(ARGV[base + 1])
+    local rate = tonumber(ARGV[base + 2])
+    local burst = tonumber(ARGV[base + 3])
+    local ttl = tonumber(ARGV[base + 4])
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(state[1])
+    local ts = tonumber(state[2])
+    if tokens == nil or ts == nil then
+        tokens = burst
+        ts = now
+    end
+    tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+    tokens = tokens - consumed
+    if tokens < 0 and rate > 0 then
+        ttl = ttl + math.ceil(-tokens / rate)
+    end
+    redis.call('HMSET', key, 'tokens', tokens, 'ts', now)
+    redis.call('EXPIRE', key, ttl)
+    result[i] = tostring(tokens)
+end
+return result
+"""
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'last', 'pending')
+
+    def __init__(self, rate, burst, now, tokens=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst if tokens is None else tokens)
+        self.last = now
+        self.pending = 0  # tokens consumed locally since the last Redis sync
+
+    def take(self, now):
+        elapsed = now - self.last
+        if elapsed > 0:
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+            self.last = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.pending += 1
+            return True
+        return False
+
+    def retry_after(self):
+        return max(0.0, (1 - self.tokens) / self.rate) if self.rate > 0 else 1.0
+
+
+class RateLimiter:
+    """Per-client token buckets kept in process and reconciled with Redis in the background.
+
+    `allow()` only touches local memory. A daemon thread (started lazily, so each
+    gunicorn worker gets its own; pass autostart_sync=False to drive `sync()`
+    yourself) pushes locally consumed tokens to Redis every
+    `sync_interval` seconds and pulls back the shared token count.
+
+    Every worker refills locally at the full rate, so between syncs the workers
+    together can over-admit. That excess is carried as negative tokens (debt) in
+    Redis and in the adopted local count, so admissions across all workers
+    converge to `rate` over time. A bucket first seen by a worker starts with
+    only `burst / workers` tokens until its first sync adopts the shared count.
+
+    Unsynced consumption of evicted buckets is flushed on the next sync. While
+    Redis is unreachable each bucket carries at most `burst` tokens of unsynced
+    consumption, so an outage is not charged to clients all at once afterwards.
+    """
+
+    ERROR_LOG_INTERVAL = 60  # seconds between repeated sync failure messages
+
+    def __init__(self, limits, redis_client=None, api_key_header='X-API-Key', api_keys=(), cidrs=(),
+                 trusted_proxies=(), forwarded_skip=0, workers=1, max_buckets=10000, sync_interval=1.0, batch_size=500,
+                 key_prefix='ratelimit', autostart_sync=True):
+        self.limits = limits
+        self.redis_client = redis_client
+        self.api_key_header = api_key_header
+        self.api_keys = frozenset(api_keys)
+        self.networks = [ipaddress.ip_network(c, strict=False) for c in cidrs]
+        self.trusted_proxies = [ipaddress.ip_network(c, strict=False) for c in trusted_proxies]
+        self.forwarded_skip = forwarded_skip
+        self.workers = max(1, workers)
+        self.max_buckets = max_buckets
+        self._match_cidr = functools.lru_cache(maxsize=max_buckets)(self._lookup_cidr)
+        self.sync_interval = sync_interval
+        self.batch_size = batch_size
+        self.key_prefix = key_prefix
+        self.autostart_sync = autostart_sync
+
+        self.buckets = OrderedDict()
+        self.evicted = {}  # evicted buckets whose pending consumption has not reached Redis yet
+        self.lock = threading.Lock()
+        self._sync_script = redis_client.register_script(SYNC_SCRIPT) if redis_client else None
+        self._sync_thread = None
+
+    def get_limit(self, route, algo):
+        """Return (limit_name, rule) for a route/algo pair, or (None, None) if unlimited."""
+        route_limits = self.limits.get(route)
+        if not route_limits:
+            return None, None
+        if algo in route_limits:
+            return algo, route_limits[algo]
+        if 'default' in route_limits:
+            return 'default', route_limits['default']
+        return None, None
+
+    def client_ip(self, remote_addr, forwarded_for=None):
+        """Return the address to rate limit on.
+
+        X-Forwarded-For is client controlled, so it is only consulted when the
+        peer is a trusted proxy. The last `forwarded_skip` entries, which that
+        proxy appends after the client address (GCP front ends add the load
+        balancer IP), are dropped. The rest is walked right to left, skipping
+        further trusted proxies, to find the address the outermost trusted
+        proxy actually saw.
+        """
+        if not forwarded_for or not self._is_trusted_proxy(remote_addr):
+            return remote_addr
+        hops = [hop.strip() for hop in forwarded_for.split(',') if hop.strip()]
+        if self.forwarded_skip and len(hops) > self.forwarded_skip:
+            hops = hops[:-self.forwarded_skip]
+        for hop in reversed(hops):
+            if not self._is_trusted_proxy(hop):
+                return hop
+        return hops[0] if hops else remote_addr
+
+    def _is_trusted_proxy(self, ip):
+        if not self.trusted_proxies:
+            return False
+        try:
+            addr = ipaddress.ip_address(ip)
+        except ValueError:
+            return False
+        return any(addr in net for net in self.trusted_proxies)
+
+    def client_key(self, headers, client_ip):
+        """Identify the client by a known API key, then configured CIDR, then plain IP.
+
+        Unknown API keys are ignored so that rotating the header value cannot
+        mint fresh buckets.
+        """
+        api_key = headers.get(self.api_key_header) if self.api_key_header else None
+        if api_key and api_key in self.api_keys:
+            return 'key', f"key:{api_key}"
+        if self.networks:
+            net = self._match_cidr(client_ip)
+            if net:
+                return 'cidr', f"cidr:{net}"
+        return 'ip', f"ip:{client_ip}"
+
+    def _lookup_cidr(self, client_ip):
+        try:
+            addr = ipaddress.ip_address(client_ip)
+        except ValueError:
+            return None
+        for net in self.networks:
+            if addr in net:
+                return net
+        return None
+
+    def allow(self, route, algo, headers, client_ip):
+        """Consume a token for this request.
+
+        Returns (allowed, limit_name, key_type, retry_after). limit_name is the
+        configured entry that applied ('default' or an algorithm name), so it is
+        safe to use as a metric label. Requests on routes without a configured
+        limit are always allowed with limit_name and key_type None.
+        """
+        limit_name, rule = self.get_limit(route, algo)
+        if rule is None:
+            return True, None, None, 0.0
+        if self.autostart_sync and self._sync_script is not None and self._sync_thread is None:
+            self.start_sync()
+
+        key_type, client = self.client_key(headers, client_ip)
+        bucket_key = f"{self.key_prefix}:{route}:{limit_name}:{client}"
+        now = time.time()
+        with self.lock:
+            bucket = self.buckets.get(bucket_key)
+            if bucket is None:
+                bucket = TokenBucket(rule['rate'], rule['burst'], now, rule['burst'] / self.workers)
+                self.buckets[bucket_key] = bucket
+                if len(self.buckets) > self.max_buckets:
+                    self._retain_evicted(*self.buckets.popitem(last=False))
+            else:
+                self.buckets.move_to_end(bucket_key)
+            allowed = bucket.take(now)
+            retry_after = 0.0 if allowed else bucket.retry_after()
+        return allowed, limit_name, key_type, retry_after
+
+    def _retain_evicted(self, key, bucket):
+        # Caller holds self.lock. Beyond max_buckets pending evictions the
+        # consumption is dropped; that only happens under a key flood.
+        if not bucket.pending:
+            return
+        existing = self.evicted.get(key)
+        if existing is not None and existing is not bucket:
+            existing.pending = min(existing.burst, existing.pending + bucket.pending)
+        elif existing is None and len(self.evicted) < self.max_buckets:
+            self.evicted[key] = bucket
+
+    def start_sync(self):
+        with self.lock:
+            if self._sync_thread is not None:
+                return
+            self._sync_thread = threading.Thread(target=self._sync_loop, daemon=True)
+        self._sync_thread.start()
+
+    def _sync_loop(self):
+        failing = False
+        last_logged = 0.0
+        while True:
+            time.sleep(self.sync_interval)
+            try:
+                self.sync()
+                if failing:
+                    print("Rate limiter sync recovered")
+                    failing = False
+            except Exception as e:
+                now = time.time()
+                if not failing or now - last_logged >= self.ERROR_LOG_INTERVAL:
+                    print(f"Rate limiter sync failed: {e}")
+                    last_logged = now
+                failing = True
+
+    def _key_ttl(self, bucket):
+        # Long enough for an empty bucket to refill, plus a few sync intervals
+        margin = math.ceil(self.sync_interval * 10)
+        if bucket.rate <= 0:
+            return margin
+        return math.ceil(bucket.burst / bucket.rate) + margin
+
+    def sync(self):
+        """Push local consumption to Redis and adopt the shared token counts."""
+        now = time.time()
+        with self.lock:
+            snapshot = []
+            for key, bucket in self.evicted.items():
+                snapshot.append((key, bucket, bucket.pending, True))
+                bucket.pending = 0
+            self.evicted = {}
+            for key, bucket in self.buckets.items():
+                if bucket.pending or bucket.tokens < bucket.burst:
+                    snapshot.append((key, bucket, bucket.pending, False))
+                    bucket.pending = 0
+
+        for i in range(0, len(snapshot), self.batch_size):
+            batch = snapshot[i:i + self.batch_size]
+            args = [now]
+            for _, bucket, consumed, _ in batch:
+                args.extend((consumed, bucket.rate, bucket.burst, self._key_ttl(bucket)))
+            try:
+                result = self._sync_script(keys=[key for key, _, _, _ in batch], args=args)
+            except Exception:
+                # Keep the unsynced consumption for the next sync, but never more
+                # than a full bucket so a long outage is not charged all at once
+                with self.lock:
+                    for key, bucket, consumed, evicted in snapshot[i:]:
+                        bucket.pending = min(bucket.burst, bucket.pending + consumed)
+                        if evicted:
+                            self._retain_evicted(key, bucket)
+                raise
+
+            with self.lock:
+                for (_, bucket, _, _), tokens in zip(batch, result):
+                    # Anything consumed while the script ran is still pending;
+                    # debt is kept so over-admission is paid back, not forgiven
+                    bucket.tokens = float(tokens) - bucket.pending
+                    bucket.last = now
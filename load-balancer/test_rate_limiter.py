@@ -0,0 +1,249 @@
+import fakeredis
+import pytest
+
+import rate_limiter
+from rate_limiter import RateLimiter, TokenBucket
+
+LIMITS = {
+    '/': {
+        'default': {'rate': 1, 'burst': 2},
+        'adaptive': {'rate': 2, 'burst': 1},
+    },
+}
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class StubScript:
+    """Stands in for redis-py's registered Script; returns a fixed global token count."""
+
+    def __init__(self, tokens=0, fail=False):
+        self.tokens = tokens
+        self.fail = fail
+        self.calls = []
+        self.before_return = None
+
+    def __call__(self, keys, args):
+        self.calls.append((list(keys), list(args)))
+        if self.fail:
+            raise ConnectionError("redis down")
+        if self.before_return:
+            self.before_return()
+        return [str(self.tokens)] * len(keys)
+
+
+class StubRedis:
+    def __init__(self, script):
+        self.script = script
+
+    def register_script(self, source):
+        return self.script
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limiter.time, 'time', clock)
+    return clock
+
+
+def make_limiter(script=None, **kwargs):
+    return RateLimiter(LIMITS, redis_client=StubRedis(script) if script else None, autostart_sync=False, **kwargs)
+
+
+def test_bucket_rejects_when_empty_and_refills(clock):
+    limiter = make_limiter()
+    results = [limiter.allow('/', 'round_robin', {}, '1.2.3.4') for _ in range(3)]
+    assert [r[0] for r in results] == [True, True, False]
+    assert results[2][3] == pytest.approx(1.0)
+
+    clock.now += 0.5
+    allowed, _, _, retry_after = limiter.allow('/', 'round_robin', {}, '1.2.3.4')
+    assert not allowed
+    assert retry_after == pytest.approx(0.5)
+
+    clock.now += 0.5
+    assert limiter.allow('/', 'round_robin', {}, '1.2.3.4')[0]
+
+
+def test_refill_is_capped_at_burst():
+    bucket = TokenBucket(rate=10, burst=3, now=0)
+    bucket.tokens = 0
+    bucket.take(100)
+    assert bucket.tokens == 2
+
+
+def test_limit_name_per_algorithm_and_unlimited_routes(clock):
+    limiter = make_limiter()
+    assert limiter.allow('/', 'adaptive', {}, '1.2.3.4')[:3] == (True, 'adaptive', 'ip')
+    assert not limiter.allow('/', 'adaptive', {}, '1.2.3.4')[0]
+    # Unknown algorithms share the default bucket and label
+    assert limiter.allow('/', 'no-such-algo', {}, '1.2.3.4')[:3] == (True, 'default', 'ip')
+    assert limiter.allow('/health', 'adaptive', {}, '1.2.3.4') == (True, None, None, 0.0)
+
+
+def test_known_api_key_takes_precedence_over_cidr_and_ip():
+    limiter = make_limiter(api_keys=['tenant-a'], cidrs=['10.0.0.0/8'])
+    assert limiter.client_key({'X-API-Key': 'tenant-a'}, '10.1.2.3') == ('key', 'key:tenant-a')
+    assert limiter.client_key({}, '10.1.2.3') == ('cidr', 'cidr:10.0.0.0/8')
+    assert limiter.client_key({}, '192.168.0.1') == ('ip', 'ip:192.168.0.1')
+    assert limiter.client_key({}, 'not-an-ip') == ('ip', 'ip:not-an-ip')
+
+
+def test_unknown_api_keys_do_not_get_their_own_bucket(clock):
+    limiter = make_limiter(api_keys=['tenant-a'])
+    results = [limiter.allow('/', 'round_robin', {'X-API-Key': str(i)}, '1.2.3.4') for i in range(4)]
+    assert [r[0] for r in results] == [True, True, False, False]
+    assert {r[2] for r in results} == {'ip'}
+
+
+def test_forwarded_for_only_trusted_from_proxies():
+    limiter = make_limiter(trusted_proxies=['10.0.0.0/8'])
+    assert limiter.client_ip('1.2.3.4', '9.9.9.9') == '1.2.3.4'
+    assert limiter.client_ip('10.0.0.1', None) == '10.0.0.1'
+    assert limiter.client_ip('10.0.0.1', '9.9.9.9, 5.5.5.5, 10.0.0.2') == '5.5.5.5'
+    assert limiter.client_ip('10.0.0.1', '10.0.0.3') == '10.0.0.3'
+
+
+def test_gcp_front_end_forwarded_for():
+    limiter = make_limiter(trusted_proxies=['35.191.0.0/16', '130.211.0.0/22'], forwarded_skip=1)
+    # GFE appends "<client>, <load balancer IP>" to any header the client sent
+    assert limiter.client_ip('35.191.4.2', 'spoofed, 203.0.113.7, 34.120.0.1') == '203.0.113.7'
+    assert limiter.client_ip('35.191.4.2', '203.0.113.7, 34.120.0.1') == '203.0.113.7'
+    # Direct connections never trust the header
+    assert limiter.client_ip('198.51.100.1', '203.0.113.7, 34.120.0.1') == '198.51.100.1'
+
+
+def test_lru_eviction_keeps_recently_used_buckets(clock):
+    limiter = make_limiter(max_buckets=2)
+    limiter.allow('/', 'round_robin', {}, 'a')
+    limiter.allow('/', 'round_robin', {}, 'b')
+    limiter.allow('/', 'round_robin', {}, 'a')
+    limiter.allow('/', 'round_robin', {}, 'c')
+    assert list(limiter.buckets) == ['ratelimit:/:default:ip:a', 'ratelimit:/:default:ip:c']
+    assert limiter.evicted['ratelimit:/:default:ip:b'].pending == 1
+
+
+def test_sync_pushes_pending_and_adopts_global_count(clock):
+    script = StubScript(tokens=1.5)
+    limiter = make_limiter(script)
+    limiter.allow('/', 'round_robin', {}, '1.2.3.4')
+    bucket = limiter.buckets['ratelimit:/:default:ip:1.2.3.4']
+
+    # A request lands while the script is running
+    script.before_return = lambda: limiter.allow('/', 'round_robin', {}, '1.2.3.4')
+    limiter.sync()
+
+    keys, args = script.calls[0]
+    assert keys == ['ratelimit:/:default:ip:1.2.3.4']
+    assert args[1:] == [1, 1, 2, 12]
+    assert bucket.pending == 1
+    assert bucket.tokens == pytest.approx(0.5)
+
+
+def test_sync_batches_keys(clock):
+    script = StubScript(tokens=2)
+    limiter = make_limiter(script, batch_size=2)
+    for ip in ('a', 'b', 'c'):
+        limiter.allow('/', 'round_robin', {}, ip)
+    limiter.sync()
+    assert [len(keys) for keys, _ in script.calls] == [2, 1]
+    assert all(b.pending == 0 for b in limiter.buckets.values())
+
+
+def test_sync_flushes_evicted_buckets(clock):
+    script = StubScript(tokens=2)
+    limiter = make_limiter(script, max_buckets=1)
+    limiter.allow('/', 'round_robin', {}, 'a')
+    limiter.allow('/', 'round_robin', {}, 'b')
+    limiter.sync()
+    assert sorted(script.calls[0][0]) == ['ratelimit:/:default:ip:a', 'ratelimit:/:default:ip:b']
+    assert limiter.evicted == {}
+
+
+def test_sync_failure_restores_pending_capped_at_burst(clock):
+    script = StubScript(fail=True)
+    limiter = make_limiter(script, max_buckets=1)
+    limiter.allow('/', 'round_robin', {}, 'a')
+    limiter.allow('/', 'round_robin', {}, 'b')
+    evicted = limiter.evicted['ratelimit:/:default:ip:a']
+    bucket = limiter.buckets['ratelimit:/:default:ip:b']
+
+    with pytest.raises(ConnectionError):
+        limiter.sync()
+    assert bucket.pending == 1
+    assert limiter.evicted == {'ratelimit:/:default:ip:a': evicted}
+
+    for _ in range(5):
+        clock.now += 1
+        limiter.allow('/', 'round_robin', {}, 'b')
+        with pytest.raises(ConnectionError):
+            limiter.sync()
+    assert bucket.pending == 2
+
+
+def test_sync_script_against_redis(clock):
+    redis_client = fakeredis.FakeRedis(decode_responses=True)
+    first = RateLimiter(LIMITS, redis_client=redis_client, autostart_sync=False)
+    second = RateLimiter(LIMITS, redis_client=redis_client, autostart_sync=False)
+
+    first.allow('/', 'round_robin', {}, '1.2.3.4')
+    first.sync()
+    second.allow('/', 'round_robin', {}, '1.2.3.4')
+    second.sync()
+    # Both workers' consumption has reached Redis
+    assert float(redis_client.hget('ratelimit:/:default:ip:1.2.3.4', 'tokens')) == 0
+    assert redis_client.ttl('ratelimit:/:default:ip:1.2.3.4') > 0
+
+    first.sync()
+    assert not first.allow('/', 'round_robin', {}, '1.2.3.4')[0]
+
+    clock.now += 1
+    first.sync()
+    assert float(redis_client.hget('ratelimit:/:default:ip:1.2.3.4', 'tokens')) == pytest.approx(1)
+
+
+def test_redis_key_outlives_slow_refill_and_debt(clock):
+    redis_client = fakeredis.FakeRedis(decode_responses=True)
+    limits = {'/': {'default': {'rate': 0.1, 'burst': 5}}}
+    first = RateLimiter(limits, redis_client=redis_client, autostart_sync=False)
+    second = RateLimiter(limits, redis_client=redis_client, autostart_sync=False)
+    for limiter in (first, second):
+        for _ in range(5):
+            limiter.allow('/', 'round_robin', {}, '1.2.3.4')
+        limiter.sync()
+
+    key = 'ratelimit:/:default:ip:1.2.3.4'
+    assert float(redis_client.hget(key, 'tokens')) == -5
+    # 50s to refill a full bucket, 50s to repay the debt, plus the margin
+    assert redis_client.ttl(key) == 110
+
+
+def test_workers_share_the_rate_through_redis(clock):
+    redis_client = fakeredis.FakeRedis(decode_responses=True)
+    limits = {'/': {'default': {'rate': 20, 'burst': 40}}}
+    workers = [RateLimiter(limits, redis_client=redis_client, workers=4, autostart_sync=False) for _ in range(4)]
+
+    # Each worker sees 100 req/s from the same client and syncs once a second, staggered
+    admitted = []
+    start = clock.now
+    for step in range(6000):
+        clock.now = start + step * 0.01
+        for i, worker in enumerate(workers):
+            if step % 100 == i * 25:
+                worker.sync()
+            if worker.allow('/', 'round_robin', {}, '1.2.3.4')[0]:
+                admitted.append(step)
+
+    total = len(admitted)
+    # One initial burst plus 20/s, with some slack for the final unsynced interval
+    assert 40 + 20 * 60 <= total <= 40 + 20 * 60 + 4 * 20
+    # Steady state: the second half admits the configured rate, not rate * workers
+    late = [step for step in admitted if step >= 3000]
+    assert len(late) == pytest.approx(20 * 30, rel=0.1)